@@ -14,6 +14,11 @@
  limitations under the License.
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+
 import cv2
 import numpy as np
 
@@ -21,6 +26,25 @@ from .image_model import ImageModel
 from .types import NumericalValue, ListValue, StringValue
 from .utils import nms, load_labels
 
+# Masks of different instances are built independently and OpenCV releases the GIL while processing them.
+# OpenCV also parallelizes inside its own calls, so only a few threads are used and small batches run serially.
+_POOL_WORKERS = min(4, os.cpu_count() or 1)
+_PARALLEL_MIN_INSTANCES = 8
+
+
+@lru_cache(maxsize=1)
+def _instance_pool():
+    return ThreadPoolExecutor(max_workers=_POOL_WORKERS)
+
+
+def _map_instances(func, im_masks, *args):
+    if _POOL_WORKERS < 2 or len(im_masks) < _PARALLEL_MIN_INSTANCES:
+        for im_mask, *instance_args in zip(im_masks, *args):
+            func(im_mask, *instance_args)
+        return
+    # list() consumes the results, so an exception raised in a worker is re-raised here
+    list(_instance_pool().map(func, im_masks, *args))
+
 
 class MaskRCNNModel(ImageModel):
     __model__ = 'MaskRCNN'
@@ -98,56 +122,51 @@ class MaskRCNNModel(ImageModel):
             outputs[self.output_blob_name['boxes']][:, :4]
         scores = outputs[self.output_blob_name['scores']] if self.is_segmentoly else \
             outputs[self.output_blob_name['boxes']][:, 4]
-        scale_x = meta['resized_shape'][1] / meta['original_shape'][1]
-        scale_y = meta['resized_shape'][0] / meta['original_shape'][0]
-        boxes[:, 0::2] /= scale_x
-        boxes[:, 1::2] /= scale_y
         if self.is_segmentoly:
             classes = outputs[self.output_blob_name['labels']].astype(np.uint32)
         else:
             classes = outputs[self.output_blob_name['labels']].astype(np.uint32) + 1
-        masks = []
-        for box, cls, raw_mask in zip(boxes, classes, outputs[self.output_blob_name['masks']]):
-            raw_cls_mask = raw_mask[cls, ...] if self.is_segmentoly else raw_mask
-            masks.append(self._segm_postprocess(box, raw_cls_mask, *meta['original_shape'][:-1]))
-        # Filter out detections with low confidence.
+        # Filter out detections with low confidence before building their masks.
         detections_filter = scores > self.confidence_threshold
         scores = scores[detections_filter]
         classes = classes[detections_filter]
         boxes = boxes[detections_filter]
-        masks = [segm for segm, is_valid in zip(masks, detections_filter) if is_valid]
-        return scores, classes, boxes, masks
+        # Scale the filtered boxes in place with a single broadcast multiplication.
+        scale_x = meta['resized_shape'][1] / meta['original_shape'][1]
+        scale_y = meta['resized_shape'][0] / meta['original_shape'][0]
+        boxes *= np.array([1 / scale_x, 1 / scale_y, 1 / scale_x, 1 / scale_y], dtype=boxes.dtype)
+        raw_masks = outputs[self.output_blob_name['masks']][detections_filter]
+        im_h, im_w = meta['original_shape'][:-1]
+        # Raw masks get a one pixel zero border, so boxes are expanded by the same ratio.
+        mask_size = raw_masks.shape[-2]
+        extended_boxes, clipped_boxes = self._expand_boxes(boxes, (mask_size + 2.0) / mask_size, im_h, im_w)
+        raw_cls_masks = raw_masks[np.arange(len(classes)), classes] if self.is_segmentoly else raw_masks
+        masks = np.zeros((len(boxes), im_h, im_w), dtype=np.uint8)
+        _map_instances(self._segm_postprocess, masks, extended_boxes, clipped_boxes, raw_cls_masks)
+        return scores, classes, boxes, list(masks)
 
     @staticmethod
-    def _expand_box(box, scale):
-        w_half = (box[2] - box[0]) * .5
-        h_half = (box[3] - box[1]) * .5
-        x_c = (box[2] + box[0]) * .5
-        y_c = (box[3] + box[1]) * .5
-        w_half *= scale
-        h_half *= scale
-        box_exp = np.zeros(box.shape)
-        box_exp[0] = x_c - w_half
-        box_exp[2] = x_c + w_half
-        box_exp[1] = y_c - h_half
-        box_exp[3] = y_c + h_half
-        return box_exp
-
-    def _segm_postprocess(self, box, raw_cls_mask, im_h, im_w):
+    def _expand_boxes(boxes, scale, im_h, im_w):
+        half_sizes = (boxes[:, 2:] - boxes[:, :2]) * .5
+        centers = (boxes[:, 2:] + boxes[:, :2]) * .5
+        half_sizes *= scale
+        extended_boxes = np.concatenate((centers - half_sizes, centers + half_sizes), axis=1).astype(int)
+        clipped_boxes = np.concatenate((extended_boxes[:, :2], extended_boxes[:, 2:] + 1), axis=1)
+        np.clip(clipped_boxes, 0, [im_w, im_h, im_w, im_h], out=clipped_boxes)
+        return extended_boxes, clipped_boxes
+
+    def _segm_postprocess(self, im_mask, extended_box, clipped_box, raw_cls_mask):
         # Add zero border to prevent upsampling artifacts on segment borders.
         raw_cls_mask = np.pad(raw_cls_mask, ((1, 1), (1, 1)), 'constant', constant_values=0)
-        extended_box = self._expand_box(box, raw_cls_mask.shape[0] / (raw_cls_mask.shape[0] - 2.0)).astype(int)
         w, h = np.maximum(extended_box[2:] - extended_box[:2] + 1, 1)
-        x0, y0 = np.clip(extended_box[:2], a_min=0, a_max=[im_w, im_h])
-        x1, y1 = np.clip(extended_box[2:] + 1, a_min=0, a_max=[im_w, im_h])
+        x0, y0, x1, y1 = clipped_box
 
-        raw_cls_mask = cv2.resize(raw_cls_mask.astype(np.float32), (w, h)) > 0.5
-        mask = raw_cls_mask.astype(np.uint8)
+        # Binarize before upsampling, nearest-neighbor resize of a uint8 mask is much cheaper than
+        # a bilinear one of a float mask at the cost of slightly coarser segment borders.
+        mask = cv2.resize((raw_cls_mask > 0.5).astype(np.uint8), (w, h), interpolation=cv2.INTER_NEAREST)
         # Put an object mask in an image mask.
-        im_mask = np.zeros((im_h, im_w), dtype=np.uint8)
-        im_mask[y0:y1, x0:x1] = mask[(y0 - extended_box[1]):(y1 - extended_box[1]),
-                                    (x0 - extended_box[0]):(x1 - extended_box[0])]
-        return im_mask
+        cv2.copyTo(mask[(y0 - extended_box[1]):(y1 - extended_box[1]), (x0 - extended_box[0]):(x1 - extended_box[0])],
+                   None, dst=im_mask[y0:y1, x0:x1])
 
 
 class YolactModel(ImageModel):
@@ -168,6 +187,10 @@ class YolactModel(ImageModel):
                 default_value=0.5,
                 description='Probability threshold for detections filtering'
             ),
+            'max_detections': NumericalValue(
+                value_type=int, default_value=100, min=1,
+                description='Maximum number of detections with the highest scores to build masks for'
+            ),
             'labels': ListValue(description="List of class labels"),
             'path_to_labels': StringValue(
                 description="Path to file with labels. Overrides the labels"
@@ -201,36 +224,32 @@ class YolactModel(ImageModel):
         conf = np.transpose(outputs['conf'][0])
         masks = outputs['mask'][0]
         proto = outputs['proto'][0]
-        num_classes = conf.shape[0]
-        idx_lst, cls_lst, scr_lst = [], [], []
         shift_x = (input_width - (frame_width * scale_x)) / frame_width
         shift_y = (input_height - (frame_height * scale_y)) / frame_height
 
-        for cls in range(1, num_classes):
-            cls_scores = conf[cls, :]
-            idx = np.arange(cls_scores.shape[0])
-            conf_mask = cls_scores > self.confidence_threshold
-
-            cls_scores = cls_scores[conf_mask]
-            idx = idx[conf_mask]
-
-            if cls_scores.shape[0] == 0:
-                continue
-            x1, x2 = self._sanitize_coordinates(boxes[idx, 0], boxes[idx, 2], frame_width)
-            y1, y2 = self._sanitize_coordinates(boxes[idx, 1], boxes[idx, 3], frame_height)
-            keep = nms(x1, y1, x2, y2, cls_scores, 0.5)
-
-            idx_lst.append(idx[keep])
-            cls_lst.append(np.full(len(keep), cls))
-            scr_lst.append(cls_scores[keep])
-
-        if not idx_lst:
+        # Background class is skipped
+        classes, idx = np.nonzero(conf[1:] > self.confidence_threshold)
+        if idx.size == 0:
             return np.array([]), np.array([]), np.array([]), np.array([])
-        idx = np.concatenate(idx_lst, axis=0)
-        classes = np.concatenate(cls_lst, axis=0)
-        scores = np.concatenate(scr_lst, axis=0)
-
-        idx2 = np.argsort(scores, axis=0)[::-1]
+        classes += 1
+        scores = conf[classes, idx]
+
+        # Candidates are grouped by class, so NMS runs once per contiguous slice of a class present in the frame
+        x1, y1, x2, y2 = self._sanitize_boxes(boxes[idx], frame_width, frame_height).T
+        bounds = np.flatnonzero(np.diff(classes)) + 1
+        keep = np.concatenate([
+            start + nms(x1[start:end], y1[start:end], x2[start:end], y2[start:end], scores[start:end], 0.5)
+            for start, end in zip(np.r_[0, bounds], np.r_[bounds, idx.size])
+        ])
+
+        idx = idx[keep]
+        classes = classes[keep]
+        scores = scores[keep]
+
+        # Only the top scoring detections are kept, so select them before sorting
+        top_k = min(len(scores), self.max_detections)
+        idx2 = np.argpartition(-scores, top_k - 1)[:top_k]
+        idx2 = idx2[np.argsort(-scores[idx2])]
         scores = scores[idx2]
 
         idx = idx[idx2]
@@ -254,46 +273,72 @@ class YolactModel(ImageModel):
             if np.size(score) == 0:
                 return [] * 4
 
-        masks = proto_data @ masks.T
-        masks = 1 / (1 + np.exp(-masks))
-        masks = self._crop_mask(masks, boxes)
+        # sigmoid(x) > 0.5 is equivalent to x > 0, so the masks are kept as logits. The area around a box
+        # is filled with a large negative logit, so bilinear upsampling cannot spread a mask past its crop.
+        proto_h, proto_w, proto_channels = proto_data.shape
+        masks = masks.astype(np.float32, copy=False) @ \
+            proto_data.reshape(-1, proto_channels).astype(np.float32, copy=False).T
+        masks = masks.reshape(-1, proto_h, proto_w)
+        crop_boxes = self._sanitize_boxes(boxes, proto_w, proto_h, padding=1)
+        masks = self._crop_mask(masks, crop_boxes)
+        regions = self._frame_regions(crop_boxes, proto_w, proto_h, w, h)
 
-        masks = np.transpose(masks, (2, 0, 1))
-        boxes[:, 0], boxes[:, 2] = self._sanitize_coordinates(boxes[:, 0], boxes[:, 2], w, shift_x)
-        boxes[:, 1], boxes[:, 3] = self._sanitize_coordinates(boxes[:, 1], boxes[:, 3], h, shift_y)
-        ready_masks = []
+        boxes = self._sanitize_boxes(boxes, w, h, shift_x, shift_y)
+        ready_masks = np.zeros((len(masks), h, w), dtype=np.uint8)
 
-        for mask in masks:
-            mask = cv2.resize(mask, (w, h), cv2.INTER_LINEAR)
-            mask = mask > 0.5
-            ready_masks.append(mask.astype(np.uint8))
+        _map_instances(self._upsample_mask, ready_masks, masks, regions, repeat(proto_w / w), repeat(proto_h / h))
 
-        return boxes, score, classes, ready_masks
+        return boxes, score, classes, list(ready_masks)
 
-    def _crop_mask(self, masks, boxes, padding: int = 1):
-        h, w, n = np.shape(masks)
-        x1, x2 = self._sanitize_coordinates(boxes[:, 0], boxes[:, 2], w, padding=padding)
-        y1, y2 = self._sanitize_coordinates(boxes[:, 1], boxes[:, 3], h, padding=padding)
-
-        rows = np.reshape(
-            np.repeat(np.reshape(np.repeat(np.arange(w, dtype=x1.dtype), h), (w, h)), n, axis=-1), (h, w, n)
-        )
-        cols = np.reshape(
-            np.repeat(np.reshape(np.repeat(np.arange(h, dtype=x1.dtype), h), (w, h)), n, axis=-1), (h, w, n)
-        )
-        rows = np.transpose(rows, (1, 0, 2))
+    @staticmethod
+    def _upsample_mask(im_mask, mask, region, scale_x, scale_y):
+        # Upsample only the part of the frame covered by a cropped mask. The inverse map
+        # is the one of cv2.resize from the proto size to the frame size.
+        x0, y0, x1, y1 = region
+        if x1 <= x0 or y1 <= y0:
+            return
+        transform = np.array([[scale_x, 0, (x0 + 0.5) * scale_x - 0.5],
+                              [0, scale_y, (y0 + 0.5) * scale_y - 0.5]])
+        mask = cv2.warpAffine(mask, transform, (int(x1 - x0), int(y1 - y0)),
+                              flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+        np.greater(mask, 0, out=im_mask[y0:y1, x0:x1])
+
+    def _crop_mask(self, masks, crop_boxes):
+        n, h, w = np.shape(masks)
+        x1, y1, x2, y2 = crop_boxes.T[:, :, None, None]
+
+        rows, cols = self._coordinate_ranges(h, w, crop_boxes.dtype)
 
         masks_left = rows >= x1
         masks_right = rows < x2
         masks_up = cols >= y1
         masks_down = cols < y2
-        crop_mask = masks_left * masks_right * masks_up * masks_down
-        return masks * crop_mask
+        crop_mask = masks_left & masks_right & masks_up & masks_down
+        return np.where(crop_mask, masks, np.float32(-1e4))
+
+    @staticmethod
+    def _frame_regions(crop_boxes, proto_w, proto_h, w, h):
+        # A bilinearly upsampled frame pixel x reads proto columns around (x + 0.5) * proto_w / w - 0.5.
+        # Pixels reading further than half a proto pixel past the cropped columns take at least half of
+        # their value from the negative fill, so they are never part of the mask.
+        scale = np.array([w / proto_w, h / proto_h])
+        regions = np.concatenate((np.ceil(np.ceil(crop_boxes[:, :2]) * scale - 0.5),
+                                  np.floor(np.ceil(crop_boxes[:, 2:]) * scale - 0.5) + 1), axis=1)
+        return np.clip(regions, 0, [w, h, w, h]).astype(int)
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _coordinate_ranges(h, w, dtype):
+        # Proto size is fixed for a model, so the ranges are built once and shared between frames
+        rows = np.arange(w, dtype=dtype)[None, None, :]
+        cols = np.arange(h, dtype=dtype)[None, :, None]
+        rows.flags.writeable = False
+        cols.flags.writeable = False
+        return rows, cols
 
     @staticmethod
-    def _sanitize_coordinates(_x1, _x2, img_size, shift=0, padding=0):
-        _x1 = (_x1 + shift / 2) * img_size
-        _x2 = (_x2 + shift / 2) * img_size
-        x1 = np.clip(_x1 - padding, 0, img_size)
-        x2 = np.clip(_x2 + padding, 0, img_size)
-        return x1, x2
+    def _sanitize_boxes(boxes, w, h, shift_x=0, shift_y=0, padding=0):
+        size = np.array([w, h, w, h], dtype=boxes.dtype)
+        shift = np.array([shift_x, shift_y, shift_x, shift_y], dtype=boxes.dtype) / 2
+        padding = np.array([-padding, -padding, padding, padding], dtype=boxes.dtype)
+        return np.clip((boxes + shift) * size + padding, 0, size)
@@ -17,6 +17,11 @@
 import cv2
 import numpy as np
 import math
+try:
+    from numba import njit
+    numba_absent = False
+except ImportError:
+    numba_absent = True
 
 
 class Detection:
@@ -178,6 +183,10 @@ INTERPOLATION_TYPES = {
 }
 
 
+# The pairwise overlap matrix of the NumPy nms path takes about 50 MB for this many boxes
+_NMS_MATRIX_MAX_BOXES = 1000
+
+
 def nms(x1, y1, x2, y2, scores, thresh, include_boundaries=False, keep_top_k=None):
     b = 1 if include_boundaries else 0
     areas = (x2 - x1 + b) * (y2 - y1 + b)
@@ -186,10 +195,45 @@ def nms(x1, y1, x2, y2, scores, thresh, include_boundaries=False, keep_top_k=Non
     if keep_top_k:
         order = order[:keep_top_k]
 
-    keep = []
+    if not numba_absent:
+        return _nms_numba(x1, y1, x2, y2, order, areas, thresh, b)
+    if order.size > _NMS_MATRIX_MAX_BOXES:
+        return _nms_incremental(x1, y1, x2, y2, order, areas, thresh, b)
+    return _nms_matrix(x1, y1, x2, y2, order, areas, thresh, b)
+
+
+def _nms_matrix(x1, y1, x2, y2, order, areas, thresh, b):
+    # Compute all pairwise overlaps of the sorted boxes at once and sweep them afterwards
+    x1, y1, x2, y2, areas = x1[order], y1[order], x2[order], y2[order], areas[order]
+    w = np.maximum(0.0, np.minimum(x2[:, None], x2[None, :]) - np.maximum(x1[:, None], x1[None, :]) + b)
+    h = np.maximum(0.0, np.minimum(y2[:, None], y2[None, :]) - np.maximum(y1[:, None], y1[None, :]) + b)
+    intersection = w * h
+
+    union = areas[:, None] + areas[None, :] - intersection
+    # intersection <= union, so the epsilon only matters for empty boxes where both are zero
+    overlap = intersection / (union + 1e-12)
+
+    suppressed = np.zeros(order.size, dtype=bool)
+    keep = np.empty(order.size, dtype=np.int64)
+    keep_size = 0
+    for i in range(order.size):
+        if suppressed[i]:
+            continue
+        keep[keep_size] = order[i]
+        keep_size += 1
+        suppressed[i + 1:] |= overlap[i, i + 1:] > thresh
+
+    return keep[:keep_size]
+
+
+def _nms_incremental(x1, y1, x2, y2, order, areas, thresh, b):
+    # Compare each kept box only with the boxes still left, so memory stays linear in the number of boxes
+    keep = np.empty(order.size, dtype=np.int64)
+    keep_size = 0
     while order.size > 0:
         i = order[0]
-        keep.append(i)
+        keep[keep_size] = i
+        keep_size += 1
 
         xx1 = np.maximum(x1[i], x1[order[1:]])
         yy1 = np.maximum(y1[i], y1[order[1:]])
@@ -200,12 +244,38 @@ def nms(x1, y1, x2, y2, scores, thresh, include_boundaries=False, keep_top_k=Non
         h = np.maximum(0.0, yy2 - yy1 + b)
         intersection = w * h
 
-        union = (areas[i] + areas[order[1:]] - intersection)
-        overlap = np.divide(intersection, union, out=np.zeros_like(intersection, dtype=float), where=union != 0)
-
+        union = areas[i] + areas[order[1:]] - intersection
+        overlap = intersection / (union + 1e-12)
         order = order[np.where(overlap <= thresh)[0] + 1]
 
-    return keep
+    return keep[:keep_size]
+
+
+def _nms_numba(x1, y1, x2, y2, order, areas, thresh, b):
+    suppressed = np.zeros(order.size, dtype=np.bool_)
+    keep = np.empty(order.size, dtype=np.int64)
+    keep_size = 0
+    for _i in range(order.size):
+        if suppressed[_i]:
+            continue
+        i = order[_i]
+        keep[keep_size] = i
+        keep_size += 1
+        for _j in range(_i + 1, order.size):
+            if suppressed[_j]:
+                continue
+            j = order[_j]
+            w = max(0.0, min(x2[i], x2[j]) - max(x1[i], x1[j]) + b)
+            h = max(0.0, min(y2[i], y2[j]) - max(y1[i], y1[j]) + b)
+            intersection = w * h
+            union = areas[i] + areas[j] - intersection
+            if intersection / (union + 1e-12) > thresh:
+                suppressed[_j] = True
+    return keep[:keep_size]
+
+
+if not numba_absent:
+    _nms_numba = njit(cache=True)(_nms_numba)
 
 
 def softmax(logits, axis=None, keepdims=False):